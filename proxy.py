@@ -7,27 +7,115 @@ for server-side media analysis.
 """
 
 import asyncio
-import json
-import re
+import collections
+import logging
+import time
 from typing import Optional
 from urllib.parse import urlparse, urlencode, parse_qs
 
 import aiohttp
+import orjson
 from aiohttp import web
+from multidict import CIMultiDict
+
+logger = logging.getLogger(__name__)
+
+# No total deadline: Emby long-polls (session control, server events) can
+# legitimately outlive any blanket cap. Stuck connects/reads still fail fast.
+# Built once here so pass_through doesn't allocate a timeout per request.
+_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=60)
+
+# Path prefixes worth logging when forwarding (reduce noise for static assets)
+_LOGGED_PREFIXES = ('/emby/Users/', '/Users/', '/emby/Sessions/', '/Sessions/')
+
+# Hop-by-hop headers that must not be forwarded in either direction
+_HOP_BY_HOP = frozenset({
+    'connection', 'host', 'keep-alive', 'proxy-connection',
+    'transfer-encoding', 'upgrade',
+})
+
+# Request headers Emby actually needs; everything else (forwarded-for
+# chains, sec-fetch-*, etc.) is dead weight on every proxied request
+_FORWARD_REQ_HEADERS = frozenset({
+    'authorization',
+    'x-emby-token', 'x-emby-authorization',
+    'x-emby-client', 'x-emby-client-version',
+    'x-emby-device-id', 'x-emby-device-name', 'x-emby-language',
+    'user-agent', 'accept', 'accept-encoding', 'accept-language',
+    'content-type', 'content-length',
+    'range', 'cookie', 'if-none-match', 'if-modified-since',
+})
+
+
+# Pre-serialized PlaybackInfo body. The structure is constant per intercept;
+# only the item ID and stream URL vary, so substitute those into the template
+# instead of building and encoding a dict on every request.
+_PLAYBACK_INFO_TEMPLATE = (
+    b'{"MediaSources":[{'
+    b'"Id":"__ID__",'
+    b'"Protocol":"Http",'
+    b'"Type":"Default",'
+    b'"Container":"",'  # Player will detect
+    b'"IsRemote":true,'
+    b'"SupportsTranscoding":true,'
+    b'"IsInfiniteStream":false,'
+    b'"IsIO":false,'
+    b'"DefaultAudioStreamIndex":null,'
+    b'"DefaultSubtitleStreamIndex":null,'
+    b'"DirectStreamUrl":"__URL__"'
+    b'}],"PlaySessionId":"play___ID__"}'
+)
 
 
 class EmbyProxyHandler:
     """Handles HTTP requests to Emby server."""
     
+    # Max item IDs remembered as not-strm before evicting the oldest
+    NOT_STRM_CACHE_SIZE = 10_000
+    # strm content cache: entries expire after this many seconds
+    STRM_CACHE_TTL = 300
+    STRM_CACHE_SIZE = 1_000
+    # A strm file is a URL plus a newline - a few hundred bytes. Anything
+    # larger coming out of Download is the actual media of a non-strm
+    # item (the speculative fetch races the classification), so never
+    # read past this
+    STRM_MAX_BYTES = 16_384
+
     def __init__(self, emby_server_url: str, emby_api_key: str):
         self.emby_server = emby_server_url
         self.api_key = emby_api_key
         self.session: Optional[aiohttp.ClientSession] = None
+        # Item IDs known not to be strm - most libraries are mostly
+        # non-strm, so this skips the lookup round-trips on repeat plays
+        self._not_strm: collections.OrderedDict = collections.OrderedDict()
+        # Item ID -> projected item info for items known to be strm
+        self._is_strm: dict = {}
+        # Item ID -> (fetch time, strm URL); a strm file's URL rarely
+        # changes mid-session, so skip the Download round-trip on repeats
+        self._strm_cache: dict = {}
+        # (kind, item_id) -> Future for upstream fetches currently in
+        # flight, so concurrent duplicates share one round-trip
+        self._inflight: dict = {}
     
     async def initialize(self):
         """Initialize HTTP session."""
+        # All traffic goes to a single Emby host, so give it a generous
+        # per-host pool, a long DNS TTL and keepalive so sockets get reused
+        # instead of churning through reconnects under load.
+        #
+        # HTTP/2 multiplexing (e.g. via httpx) was considered and rejected:
+        # Emby serves plain HTTP/1.1 (h2 needs TLS+ALPN via a reverse
+        # proxy), and parallel pooled HTTP/1.1 connections already avoid
+        # head-of-line blocking between concurrent proxied requests.
+        connector = aiohttp.TCPConnector(
+            limit=0,
+            limit_per_host=256,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
         # Disable automatic decompression so we can forward responses as-is
-        self.session = aiohttp.ClientSession(auto_decompress=False)
+        self.session = aiohttp.ClientSession(connector=connector, auto_decompress=False)
     
     async def close(self):
         """Close HTTP session."""
@@ -36,107 +124,175 @@ class EmbyProxyHandler:
     
     def is_strm_file(self, item_info: dict) -> bool:
         """Check if an item is a strm file based on its metadata."""
-        # Check by file extension in path
-        path = item_info.get('Path', '')
-        return path.lower().endswith('.strm')
-    
-    def is_playback_info_request(self, path: str) -> bool:
-        """Check if request is for PlaybackInfo endpoint."""
-        return path and '/Items/' in path and '/PlaybackInfo' in path
-    
-    def extract_item_id(self, path: str) -> Optional[str]:
-        """Extract item ID from path like /Items/{id}/PlaybackInfo."""
-        if not path:
-            return None
-        match = re.search(r'/Items/([^/]+)/PlaybackInfo', path)
-        return match.group(1) if match else None
+        # Check by file extension in path; lowercase only the 5-char
+        # suffix instead of copying the whole (often long) library path
+        path = item_info.get('Path') or ''
+        return len(path) >= 5 and path[-5:].lower() == '.strm'
     
     def get_path(self, request: web.Request) -> str:
         """Get the full path with query string from request."""
-        return str(request.rel_url)
+        # path_qs is a precomputed attribute; str(request.rel_url) would
+        # re-serialize the parsed URL on every call
+        return request.path_qs
     
+    async def _coalesced(self, key, fetch):
+        """Run fetch(), sharing the result with concurrent callers.
+
+        If an identical fetch is already in flight, await its future
+        instead of issuing a duplicate upstream round-trip. Bursts of
+        PlaybackInfo requests for the same item (common while skimming on
+        web/mobile clients) collapse to a single Emby request.
+        """
+        fut = self._inflight.get(key)
+        if fut is not None:
+            return await fut
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            result = await fetch()
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # we re-raise below; waiters retrieve their own
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
     async def fetch_item_info(self, item_id: str) -> Optional[dict]:
-        """Fetch basic item information from Emby."""
+        """Fetch basic item information from Emby, coalescing duplicates."""
+        return await self._coalesced(('item', item_id),
+                                     lambda: self._request_item_info(item_id))
+
+    async def _request_item_info(self, item_id: str) -> Optional[dict]:
+        """Issue the actual item-info request.
+
+        Only the fields we actually use are kept; the full item document
+        (MediaStreams, ProviderIds, etc. dominate its size) is dropped
+        immediately so it can be freed right after parsing.
+        """
         url = f"{self.emby_server}/Items/{item_id}?api_key={self.api_key}"
         async with self.session.get(url) as resp:
             if resp.status == 200:
-                return await resp.json()
+                item = orjson.loads(await resp.read())
+                return {
+                    'Id': item.get('Id'),
+                    'Name': item.get('Name'),
+                    'Path': item.get('Path', ''),
+                }
         return None
     
     async def fetch_strm_content(self, item_path: str, item_id: str) -> Optional[str]:
-        """Read URL from strm file."""
+        """Read URL from strm file, coalescing duplicate downloads."""
+        entry = self._strm_cache.get(item_id)
+        if entry and time.monotonic() - entry[0] < self.STRM_CACHE_TTL:
+            return entry[1]
+        return await self._coalesced(('strm', item_id),
+                                     lambda: self._download_strm_content(item_id))
+
+    async def _download_strm_content(self, item_id: str) -> Optional[str]:
+        """Issue the actual strm download and populate the cache."""
         # Try to fetch via Emby's API
         try:
             url = f"{self.emby_server}/Items/{item_id}/Download?api_key={self.api_key}"
             async with self.session.get(url) as resp:
                 if resp.status == 200:
-                    content = await resp.text()
-                    return content.strip()
+                    # Bail out before buffering if this is clearly not a
+                    # strm file; closing the response unread drops the
+                    # connection instead of pulling the media through
+                    if resp.content_length is not None \
+                            and resp.content_length > self.STRM_MAX_BYTES:
+                        return None
+                    raw = await resp.content.read(self.STRM_MAX_BYTES + 1)
+                    if len(raw) > self.STRM_MAX_BYTES:
+                        return None
+                    content = raw.decode('utf-8').strip()
+                    # Guard the cache insert on size as well - eviction is
+                    # count-based, so an oversized entry would pin memory
+                    # for the cache's whole lifetime
+                    if len(content) <= self.STRM_MAX_BYTES:
+                        self._strm_cache[item_id] = (time.monotonic(), content)
+                        if len(self._strm_cache) > self.STRM_CACHE_SIZE:
+                            # FIFO eviction: dicts keep insertion order
+                            del self._strm_cache[next(iter(self._strm_cache))]
+                    return content
         except Exception as e:
-            print(f"[DEBUG] Could not fetch via API: {e}")
+            logger.debug("Could not fetch strm content via API: %s", e)
         
         # Fallback: the path should contain the strm file path
         # In a real implementation, we'd read from the file system
         return None
     
-    def create_minimal_playback_info(self, item_info: dict, stream_url: str) -> dict:
-        """Create a minimal PlaybackInfo response that bypasses server probing."""
-        # This is the key: return minimal info and let player handle it
-        return {
-            "MediaSources": [{
-                "Id": item_info.get('Id'),
-                "Protocol": "Http",
-                "Type": "Default",
-                "Container": "",  # Player will detect
-                "IsRemote": True,
-                "SupportsTranscoding": True,
-                "IsInfiniteStream": False,
-                "IsIO": False,
-                "DefaultAudioStreamIndex": None,
-                "DefaultSubtitleStreamIndex": None,
-                "DirectStreamUrl": stream_url,
-            }],
-            "PlaySessionId": f"play_{item_info.get('Id')}",
-        }
+    def create_minimal_playback_info(self, item_info: dict, stream_url: str) -> bytes:
+        """Render the minimal PlaybackInfo body that bypasses server probing."""
+        # This is the key: return minimal info and let player handle it.
+        # orjson.dumps on a str yields the quoted JSON escape; strip the
+        # quotes and splice into the pre-serialized template.
+        item_id = orjson.dumps(str(item_info.get('Id')))[1:-1]
+        url = orjson.dumps(stream_url)[1:-1]
+        return (_PLAYBACK_INFO_TEMPLATE
+                .replace(b'__ID__', item_id)
+                .replace(b'__URL__', url))
     
     async def handle_playback_info(self, request: web.Request):
         """Intercept and modify PlaybackInfo requests for strm files."""
-        # Get the path
-        path = str(request.rel_url)
-        # Extract item ID
-        item_id = self.extract_item_id(path)
-        if not item_id:
-            # Not a playback info request or malformed, pass through
-            return await self.pass_through(request)
-        
-        # Fetch item info
-        item_info = await self.fetch_item_info(item_id)
-        if not item_info:
+        # The router matched /Items/{item_id}/PlaybackInfo, so the ID is
+        # already extracted - no string scanning needed here
+        item_id = request.match_info['item_id']
+        try:
+            return await self._intercept_playback_info(request, item_id)
+        except Exception:
+            logger.exception("Failed to handle playback info")
+            # Fallback to pass-through
             return await self.pass_through(request)
-        
-        # Check if it's a strm file
-        if not self.is_strm_file(item_info):
-            # Not a strm file, pass through normally
+
+    async def _intercept_playback_info(self, request: web.Request, item_id: str):
+        """Serve a synthetic PlaybackInfo for strm items, else pass through."""
+        # Items already known not to be strm go straight through - no
+        # point paying the lookup round-trips again on repeat plays
+        if item_id in self._not_strm:
             return await self.pass_through(request)
-        
+
+        if item_id in self._is_strm:
+            # Known strm item: only the content fetch is still needed
+            item_info = self._is_strm[item_id]
+            strm_url = await self.fetch_strm_content(None, item_id)
+        else:
+            # Fetch item info and strm content concurrently - the content
+            # fetch only needs item_id, so there is no reason to serialize
+            # the two round-trips. If the item turns out not to be strm the
+            # content fetch was wasted, but the common strm case halves its
+            # latency.
+            item_info, strm_url = await asyncio.gather(
+                self.fetch_item_info(item_id),
+                self.fetch_strm_content(None, item_id),
+            )
+            if not item_info:
+                return await self.pass_through(request)
+
+            # Check if it's a strm file
+            if not self.is_strm_file(item_info):
+                # Not a strm file, remember that and pass through normally
+                self._not_strm[item_id] = None
+                if len(self._not_strm) > self.NOT_STRM_CACHE_SIZE:
+                    self._not_strm.popitem(last=False)
+                return await self.pass_through(request)
+
+            self._is_strm[item_id] = item_info
+
         # For strm files, bypass server probing
-        print(f"[FAST] Bypassing probe for strm file: {item_info.get('Name')}")
-        
-        # Read strm file content
-        path = item_info.get('Path', '')
-        strm_url = await self.fetch_strm_content(path, item_id)
+        logger.info("Bypassing probe for strm file: %s", item_info.get('Name'))
+
         if not strm_url:
-            print(f"[WARN] Could not read strm content, passing through")
+            logger.warning("Could not read strm content, passing through")
             return await self.pass_through(request)
         
-        # Create minimal playback info
-        playback_info = self.create_minimal_playback_info(item_info, strm_url)
-        
-        # Forward original body if present
-        body = await request.read() if request.content_length else b''
-        
-        # Return modified response
-        return web.json_response(playback_info)
+        # Create minimal playback info. The request body is never used for
+        # the synthetic response; aiohttp drains it at the transport layer.
+        body = self.create_minimal_playback_info(item_info, strm_url)
+        return web.Response(body=body, content_type='application/json')
     
     async def pass_through(self, request: web.Request):
         """Pass request through to Emby server unchanged."""
@@ -145,93 +301,111 @@ class EmbyProxyHandler:
         if request.content_length and request.content_length > 0:
             data = await request.read()
         
-        # Build destination URL - use rel_url to get path with query
-        path = str(request.rel_url)
+        # Build destination URL - path_qs is the path with query, already
+        # serialized by aiohttp during request parsing
+        path = request.path_qs
         dest_url = f"{self.emby_server}{path}"
         
-        # Log requests but not all (reduce noise for static assets)
-        if '/Users/' in path or '/Sessions/' in path or request.method in ['POST', 'PUT', 'DELETE']:
-            print(f"[FORWARD] {request.method} {path}")
-            if data:
-                print(f"[DATA] {len(data)} bytes, Content-Type: {request.headers.get('Content-Type', 'none')}")
+        # Log requests but not all (reduce noise for static assets).
+        # Classify on the query-free path with a single tuple startswith
+        # rather than substring scans over the full URL, and only when
+        # debug logging is actually on.
+        if logger.isEnabledFor(logging.DEBUG):
+            if request.rel_url.path.startswith(_LOGGED_PREFIXES) \
+                    or request.method in ('POST', 'PUT', 'DELETE'):
+                logger.debug("Forwarding %s %s", request.method, path)
+                if data:
+                    logger.debug("Body: %d bytes, Content-Type: %s",
+                                 len(data), request.headers.get('Content-Type', 'none'))
         
-        # Forward headers (clean up)
-        headers = dict(request.headers)
-        # Remove connection-related headers but keep everything else
-        headers.pop('Connection', None)
-        headers.pop('Host', None)
-        # Don't remove Content-Length - it needs to be accurate
-        # The client sets this, we should forward it
+        # Forward only the headers Emby needs, in a single filtered pass.
+        # CIMultiDict preserves multi-value headers that a plain dict would merge.
+        # Content-Length is kept - the client sets it and it needs to be accurate.
+        headers = CIMultiDict(
+            (k, v) for k, v in request.headers.items()
+            if k.lower() in _FORWARD_REQ_HEADERS
+        )
         
-        # Forward request
+        # Forward request. The 503 fallback below is only valid while no
+        # response headers have gone out; once the StreamResponse is
+        # prepared, mid-stream failures are handled separately.
+        resp_out = None
         try:
             # Use the same request method and pass data as-is
             async with self.session.request(
-                request.method, dest_url, headers=headers, data=data, timeout=aiohttp.ClientTimeout(total=30)
+                request.method, dest_url, headers=headers, data=data, timeout=_DEFAULT_TIMEOUT
             ) as resp:
-                body = await resp.read()
-                
-                print(f"[RESPONSE] {resp.status} for {request.method} {path}")
-                
-                # Copy all response headers (important for proper rendering)
-                response_headers = dict(resp.headers)
-                
-                # Remove connection-specific headers that might cause issues
-                response_headers.pop('Connection', None)
-                response_headers.pop('Proxy-Connection', None)
-                response_headers.pop('Keep-Alive', None)
-                response_headers.pop('Transfer-Encoding', None)
-                
-                # Remove problematic headers
-                response_headers.pop('Content-Length', None)  # Let it be recalculated
-                
+                logger.debug("Response %d for %s %s", resp.status, request.method, path)
+
+                # Copy response headers the same way, again dropping hop-by-hop
+                # ones. Content-Length is forwarded as-is: with decompression
+                # disabled the body we relay is byte-identical to upstream.
                 # Keep Content-Encoding as-is so browser can decompress if needed
                 # Keep Content-Type, Cache-Control, etc.
-                
-                return web.Response(
-                    body=body,
-                    status=resp.status,
-                    headers=response_headers
+                response_headers = CIMultiDict(
+                    (k, v) for k, v in resp.headers.items()
+                    if k.lower() not in _HOP_BY_HOP
                 )
-        except Exception as e:
-            print(f"[ERROR] Failed to forward request to {dest_url}: {e}")
-            import traceback
-            traceback.print_exc()
+                
+                # Stream the body through instead of buffering it whole;
+                # keeps memory at one chunk per in-flight request and lets
+                # the client start receiving before upstream finishes.
+                # readany() hands over whatever the reader already buffered
+                # without the re-slicing copies iter_chunked would do to
+                # produce fixed-size pieces (StreamReader offers no readinto,
+                # so forwarding its own chunks is the allocation floor here).
+                resp_out = web.StreamResponse(status=resp.status, headers=response_headers)
+                # Mirror upstream chunked framing so long-poll and live
+                # streams keep their streaming semantics end to end
+                if 'chunked' in resp.headers.get('Transfer-Encoding', '').lower():
+                    resp_out.enable_chunked_encoding()
+                await resp_out.prepare(request)
+                # Headers are on the wire now. Upstream aborts and client
+                # disconnects mid-stream are routine; log quietly and
+                # return the partially written response - sending a fresh
+                # 503 here would splice a second set of headers into the
+                # already-started body
+                try:
+                    while True:
+                        chunk = await resp.content.readany()
+                        if not chunk:
+                            break
+                        await resp_out.write(chunk)
+                    await resp_out.write_eof()
+                except (aiohttp.ClientError, OSError) as e:
+                    logger.debug("Streaming aborted for %s %s: %s",
+                                 request.method, path, e)
+                    # Close the client connection so the truncated body
+                    # is not mistaken for a complete keep-alive response
+                    resp_out.force_close()
+                return resp_out
+        except Exception:
+            if resp_out is not None and resp_out.prepared:
+                # Can't send a clean error response any more; let aiohttp
+                # tear the connection down instead of corrupting framing
+                raise
+            logger.exception("Failed to forward request to %s", dest_url)
             return web.Response(
                 text=f"Proxy error: Could not connect to Emby server at {self.emby_server}\n\nMake sure:\n1. Emby server is running\n2. The URL is correct\n3. You can access Emby directly",
                 status=503
             )
     
-    async def handle_request(self, request):
-        """Main request handler."""
-        path = str(request.rel_url)
-        
-        # Debug logging
-        print(f"[DEBUG] {request.method} {path}")
-        
-        if self.is_playback_info_request(path):
-            try:
-                return await self.handle_playback_info(request)
-            except Exception as e:
-                print(f"[ERROR] Failed to handle playback info: {e}")
-                import traceback
-                traceback.print_exc()
-                # Fallback to pass-through
-                return await self.pass_through(request)
-        else:
-            return await self.pass_through(request)
-
-
 async def web_server(emby_server_url: str, emby_api_key: str, listen_port: int):
     """Start the proxy web server."""
+    # Default to WARNING so per-request logging stays off the hot path;
+    # bump to DEBUG when diagnosing forwarding issues
+    logging.basicConfig(level=logging.WARNING)
+
     handler = EmbyProxyHandler(emby_server_url, emby_api_key)
     await handler.initialize()
-    
-    async def handle(request):
-        return await handler.handle_request(request)
-    
+
     app = web.Application()
-    app.router.add_route('*', '/{path:.*}', handle)
+    # Let aiohttp's compiled route matcher dispatch PlaybackInfo requests
+    # instead of re-scanning every path in Python; everything else falls
+    # through to the catch-all pass-through route
+    app.router.add_route('*', '/Items/{item_id}/PlaybackInfo', handler.handle_playback_info)
+    app.router.add_route('*', '/emby/Items/{item_id}/PlaybackInfo', handler.handle_playback_info)
+    app.router.add_route('*', '/{path:.*}', handler.pass_through)
     
     runner = web.AppRunner(app)
     await runner.setup()